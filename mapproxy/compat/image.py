@@ -15,6 +15,8 @@
 
 import warnings
 
+from mapproxy.util.py import lru_cache
+
 __all__ = ['Image', 'ImageColor', 'ImageDraw', 'ImageFont', 'ImagePalette',
            'ImageChops', 'quantize']
 
@@ -26,6 +28,12 @@ try:
     Image, ImageColor, ImageDraw, ImageFont, ImagePalette, ImageChops, ImageMath
     ImageFileDirectory_v2, TiffTags
     PIL_VERSION = getattr(PIL, '__version__') or getattr(PIL, 'PILLOW_VERSION')
+    # bind once, None for PIL versions without alpha_composite
+    alpha_composite = getattr(Image, 'alpha_composite', None)
+    # Pillow >=10 only provides the Image.Quantize enum
+    LIBIMAGEQUANT = getattr(Image, 'LIBIMAGEQUANT', None)
+    if LIBIMAGEQUANT is None and hasattr(Image, 'Quantize'):
+        LIBIMAGEQUANT = Image.Quantize.LIBIMAGEQUANT
 except ImportError:
     # allow MapProxy to start without PIL (for tilecache only).
     # issue warning and raise ImportError on first use of
@@ -44,9 +52,32 @@ except ImportError:
     ImageColor = NoPIL()
     ImageColor.getrgb = lambda x: x
     PIL_VERSION = None
+    alpha_composite = None
+    LIBIMAGEQUANT = None
 
 def has_alpha_composite_support():
-    return hasattr(Image, 'alpha_composite')
+    return alpha_composite is not None
+
+@lru_cache(maxsize=1)
+def has_libimagequant_support():
+    # Pillow can be compiled with libimagequant support (Image.LIBIMAGEQUANT)
+    if LIBIMAGEQUANT is None:
+        return False
+    try:
+        from PIL import features
+        return bool(features.check_feature('libimagequant'))
+    except (ImportError, ValueError):
+        return False
+
+def alpha_channel(img):
+    """
+    Return the alpha channel of an RGBA `img` without
+    splitting all other channels.
+    """
+    if hasattr(img, 'getchannel'):
+        return img.getchannel('A')
+    # Pillow <4.3
+    return img.split()[3]
 
 def transform_uses_center():
     # transformation behavior changed with Pillow 3.4 to use pixel centers
@@ -55,6 +86,9 @@ def transform_uses_center():
         return False
     return True
 
+# lookup table to mask all pixels with alpha <= 128
+_alpha_mask_lut = [255 if a <= 128 else 0 for a in range(256)]
+
 def quantize_pil(img, colors=256, alpha=False, defaults=None):
     if hasattr(Image, 'FASTOCTREE'):
         if not alpha:
@@ -63,9 +97,9 @@ def quantize_pil(img, colors=256, alpha=False, defaults=None):
     else:
         if alpha:
             img.load() # split might fail if image is not loaded
-            alpha = img.split()[3]
+            alpha = alpha_channel(img)
             img = img.convert('RGB').convert('P', palette=Image.ADAPTIVE, colors=colors-1)
-            mask = Image.eval(alpha, lambda a: 255 if a <=128 else 0)
+            mask = alpha.point(_alpha_mask_lut)
             img.paste(255, mask)
             if defaults is not None:
                 defaults['transparency'] = 255
@@ -418,8 +418,13 @@ class ImageOptionsConfiguration(ConfigurationBase):
             raise ConfigurationError('unknown tiff_compression')
 
         quantizer = options.pop('quantizer', None)
-        if quantizer and quantizer not in ('fastoctree', 'mediancut'):
+        if quantizer and quantizer not in ('fastoctree', 'mediancut', 'libimagequant'):
             raise ConfigurationError('unknown quantizer')
+        if quantizer == 'libimagequant':
+            from mapproxy.compat.image import has_libimagequant_support
+            if not has_libimagequant_support():
+                log.warning('Pillow is not compiled with libimagequant support, '
+                    'using fastoctree quantizer')
 
         if options:
             raise ConfigurationError('unknown encoding_options: %r' % options)
@@ -21,10 +21,13 @@ from io import BytesIO
 
 
 from mapproxy.compat.image import Image, ImageChops, ImageFileDirectory_v2, TiffTags
+from mapproxy.compat.image import alpha_channel, has_libimagequant_support, LIBIMAGEQUANT
+from mapproxy.compat.image import _alpha_mask_lut
 from mapproxy.image.opts import create_image, ImageFormat
 from mapproxy.config import base_config
 from mapproxy.srs import make_lin_transf, get_epsg_num
 from mapproxy.compat import string_type
+from mapproxy.util.py import lru_cache
 
 import logging
 from functools import reduce
@@ -48,6 +51,11 @@ def peek_image_format(buf):
             return format
     return None
 
+# Keep the encoded buffer of an ImageSource when it is converted to
+# another format. Requesting the previous format again returns the
+# buffer without encoding the image again. Disable to reduce memory usage.
+KEEP_ENCODED_BUFFERS = True
+
 TIFF_MODELPIXELSCALETAG = 33550
 TIFF_MODELTIEPOINTTAG = 33922
 TIFF_GEOKEYDIRECTORYTAG = 34735
@@ -106,6 +114,7 @@ class ImageSource(object):
         self._img = None
         self._buf = None
         self._fname = None
+        self._encoded_bufs = {}
         self.source = source
         self.image_opts = image_opts
         self._size = size
@@ -120,6 +129,7 @@ class ImageSource(object):
     def source(self, source):
         self._img = None
         self._buf = None
+        self._encoded_bufs = {}
         if isinstance(source, string_type):
             self._fname = source
         elif isinstance(source, Image.Image):
@@ -161,6 +171,10 @@ class ImageSource(object):
     def _make_seekable_buf(self):
         if not self._buf and self._fname:
             self._buf = open(self._fname, 'rb')
+        elif isinstance(self._buf, ReadBufWrapper):
+            # use BytesIO directly, without the __getattr__ indirection
+            self._buf = self._buf.seekable_buf()
+            self._buf.seek(0)
         else:
             try:
                 self._buf.seek(0)
@@ -204,10 +218,24 @@ class ImageSource(object):
                 # need actual image_opts.format for next check
                 self.image_opts = self.image_opts.copy()
                 self.image_opts.format = peek_image_format(self._buf)
-            if self.image_opts and image_opts and self.image_opts.format != image_opts.format:
+            if self.image_opts and image_opts and not same_encoding(self.image_opts, image_opts):
+                ext = ImageFormat(image_opts.format).ext
+                encoded = self._encoded_bufs.get(ext)
+                # only reuse buffers encoded with the same options (colors, quality, etc.)
+                if encoded is not None and encoded[0] == image_opts:
+                    del self._encoded_bufs[ext]
+                    log.debug('reusing encoded image for %s' % (image_opts, ))
+                    encoded_bufs = self._keep_encoded_buf()
+                    self.image_opts, encoded_buf = encoded
+                    # new buffer, the kept one can still be in use by a previous caller
+                    self._buf = BytesIO(encoded_buf.getvalue())
+                    self._encoded_bufs = encoded_bufs
+                    return self._buf
                 log.debug('converting image from %s -> %s' % (self.image_opts, image_opts))
-                self.source = self.as_image()
-                self._buf = None
+                img = self.as_image()
+                encoded_bufs = self._keep_encoded_buf()
+                self.source = img
+                self._encoded_bufs = encoded_bufs
                 self.image_opts = image_opts
                 # hide fname to prevent as_buffer from reading the file
                 fname = self._fname
@@ -216,6 +244,17 @@ class ImageSource(object):
                 self._fname = fname
         return self._buf
 
+    def _keep_encoded_buf(self):
+        """
+        Return encoded buffers (by format) with the current buffer added.
+        Only in-memory buffers are kept, files are not held open.
+        """
+        encoded_bufs = self._encoded_bufs
+        if (KEEP_ENCODED_BUFFERS and self.image_opts.format
+            and isinstance(self._buf, BytesIO)):
+            encoded_bufs[ImageFormat(self.image_opts.format).ext] = (self.image_opts, self._buf)
+        return encoded_bufs
+
     @property
     def size(self):
         if self._size is None:
@@ -238,10 +277,26 @@ def SubImageSource(source, size, offset, image_opts, cacheable=True):
     img.paste(subimg, offset)
     return ImageSource(img, size=size, image_opts=new_image_opts, cacheable=cacheable)
 
+# Encoded blank images, blank tiles are requested very often
+# (e.g. for areas without data) and only differ in size and options.
+_blank_image_bufs = {}
+MAX_BLANK_IMAGE_BUFS = 256
+
+def _image_opts_key(image_opts):
+    bgcolor = image_opts.bgcolor
+    if isinstance(bgcolor, list):
+        bgcolor = tuple(bgcolor)
+    return (
+        image_opts.mode, image_opts.transparent, bgcolor,
+        image_opts.format and str(image_opts.format), image_opts.colors,
+        tuple(sorted(image_opts.encoding_options.items())),
+    )
+
 class BlankImageSource(object):
     """
     ImageSource for transparent or solid-color images.
-    Implements optimized as_buffer() method.
+    Implements optimized as_buffer() method that reuses already
+    encoded images.
     """
     def __init__(self, size, image_opts, cacheable=False):
         self.size = size
@@ -261,7 +316,17 @@ class BlankImageSource(object):
             if format:
                 image_opts.format = ImageFormat(format)
             image_opts.colors = 0
-            self._buf = img_to_buf(self.as_image(), image_opts=image_opts)
+            key = (
+                self.size, _image_opts_key(self.image_opts), _image_opts_key(image_opts),
+                base_config().image.jpeg_quality,
+            )
+            data = _blank_image_bufs.get(key)
+            if data is None:
+                data = img_to_buf(self.as_image(), image_opts=image_opts).getvalue()
+                if len(_blank_image_bufs) >= MAX_BLANK_IMAGE_BUFS:
+                    _blank_image_bufs.clear()
+                _blank_image_bufs[key] = data
+            self._buf = BytesIO(data)
         return self._buf
 
     def close_buffers(self):
@@ -289,15 +354,22 @@ class ReadBufWrapper(object):
         else:
             return iter(self.readbuf)
 
+    def seekable_buf(self):
+        """
+        Return the content of the ``readbuf`` as a seekable BytesIO.
+        """
+        if self.stringio is None:
+            self.ok_to_seek = True
+            self.stringio = BytesIO(self.readbuf.read())
+        return self.stringio
+
     def __getattr__(self, name):
         if self.stringio is None:
             if hasattr(self.readbuf, name):
                 return getattr(self.readbuf, name)
             elif name == '__length_hint__':
                 raise AttributeError
-            self.ok_to_seek = True
-            self.stringio = BytesIO(self.readbuf.read())
-        return getattr(self.stringio, name)
+        return getattr(self.seekable_buf(), name)
 
 def img_has_transparency(img):
     if img.mode == 'P':
@@ -374,31 +446,41 @@ def img_to_buf(img, image_opts, georef=None):
     return buf
 
 def quantize(img, colors=256, alpha=False, defaults=None, quantizer=None):
-    if hasattr(Image, 'FASTOCTREE') and quantizer in (None, 'fastoctree'):
-        if not alpha:
+    method = None
+    if quantizer == 'libimagequant' and has_libimagequant_support():
+        method = LIBIMAGEQUANT
+    elif hasattr(Image, 'FASTOCTREE') and quantizer in (None, 'fastoctree', 'libimagequant'):
+        method = Image.FASTOCTREE
+
+    if method is not None:
+        if not alpha and img.mode != 'RGB':
             img = img.convert('RGB')
         try:
             if img.mode == 'P':
                 # quantize with alpha does not work with P images
                 img = img.convert('RGBA')
-            img = img.quantize(colors, Image.FASTOCTREE)
+            img = img.quantize(colors, method)
         except ValueError:
             pass
     else:
         if alpha and img.mode == 'RGBA':
             img.load() # split might fail if image is not loaded
-            alpha = img.split()[3]
+            alpha = alpha_channel(img)
             img = img.convert('RGB').convert('P', palette=Image.ADAPTIVE, colors=colors-1)
-            mask = Image.eval(alpha, lambda a: 255 if a <=128 else 0)
+            mask = alpha.point(_alpha_mask_lut)
             img.paste(255, mask)
             if defaults is not None:
                 defaults['transparency'] = 255
         else:
-            img = img.convert('RGB').convert('P', palette=Image.ADAPTIVE, colors=colors)
+            if img.mode not in ('RGB', 'L'):
+                # ADAPTIVE needs RGB or L input, RGBA would result in few colors
+                img = img.convert('RGB')
+            img = img.convert('P', palette=Image.ADAPTIVE, colors=colors)
 
     return img
 
 
+@lru_cache(maxsize=64)
 def filter_format(format):
     if format.lower() == 'geotiff':
         format = 'tiff'
@@ -406,6 +488,21 @@ def filter_format(format):
         format = 'png'
     return format
 
+def same_encoding(image_opts, other_opts):
+    """
+    Check if images encoded with `image_opts` and `other_opts` are
+    interchangeable. PNG variants (e.g. png and png8) are the same
+    if they use the same number of colors.
+    """
+    if image_opts.format == other_opts.format:
+        return True
+    if not image_opts.format or not other_opts.format:
+        return False
+    format = filter_format(ImageFormat(image_opts.format).ext)
+    other_format = filter_format(ImageFormat(other_opts.format).ext)
+    return (format == other_format == 'png'
+        and image_opts.colors == other_opts.colors)
+
 image_filter = {
     'nearest': Image.NEAREST,
     'bilinear': Image.BILINEAR,
@@ -419,6 +516,9 @@ def is_single_color_image(image):
     Returns ``False`` if it contains more than one color, else
     the color-tuple of the single color.
     """
+    # getcolors stops at the second color, so multi-colored images return
+    # almost immediately. A full scan is only needed for single-color
+    # images, where getcolors is as fast as copying the pixels to NumPy.
     result = image.getcolors(1)
     # returns a list of (count, color), limit to one
     if result is None:
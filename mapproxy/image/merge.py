@@ -18,10 +18,10 @@ Image and tile manipulation (transforming, merging, etc).
 """
 
 from collections import namedtuple
-from mapproxy.compat.image import Image, ImageColor, ImageChops, ImageMath
-from mapproxy.compat.image import has_alpha_composite_support
+from mapproxy.compat.image import Image, ImageChops, ImageMath
+from mapproxy.compat.image import alpha_composite, alpha_channel
 from mapproxy.image import BlankImageSource, ImageSource
-from mapproxy.image.opts import create_image, ImageOptions
+from mapproxy.image.opts import create_image, parse_bgcolor, ImageOptions
 from mapproxy.image.mask import mask_image
 
 import logging
@@ -55,22 +55,31 @@ class LayerMerger(LayerMerger):
         """
         if not self.layers:
             return BlankImageSource(size=size, image_opts=image_opts, cacheable=True)
-        if len(self.layers) == 1:
-            layer_img, layer_coverage = self.layers[0]
-            layer_opts = layer_img.image_opts
-            if (((layer_opts and not layer_opts.transparent) or image_opts.transparent)
-                and (not size or size == layer_img.size)
-                and (not layer_coverage or not layer_coverage.clip)
-                and not coverage):
-                # layer is opaque, no need to make transparent or add bgcolor
+
+        layers = self.layers
+        if size is None and len(layers) > 1:
+            # output has the size of the bottom layer, also if it is hidden
+            size = layers[0][0].size
+        # start with the top-most opaque layer, all layers below are hidden
+        for i in range(len(layers) - 1, 0, -1):
+            if _is_opaque_layer(layers[i][0], layers[i][1], size):
+                layers = layers[i:]
+                break
+
+        if len(layers) == 1 and not coverage:
+            layer_img, layer_coverage = layers[0]
+            if _is_unmodified_layer(layer_img, layer_coverage, image_opts, size):
                 return layer_img
 
         if size is None:
-            size = self.layers[0][0].size
+            size = layers[0][0].size
 
         cacheable = self.cacheable
         result = create_image(size, image_opts)
-        for layer_img, layer_coverage in self.layers:
+        merge_composite = result.mode == 'RGBA' and alpha_composite is not None
+        # Layers are merged serially. alpha_composite does not release the GIL
+        # and requests are already processed in parallel by the server threads.
+        for layer_img, layer_coverage in layers:
             if not layer_img.cacheable:
                 cacheable = False
             img = layer_img.as_image()
@@ -83,11 +92,6 @@ class LayerMerger(LayerMerger):
             if layer_coverage and layer_coverage.clip:
                 img = mask_image(img, bbox, bbox_srs, layer_coverage)
 
-            if result.mode != 'RGBA':
-                merge_composite = False
-            else:
-                merge_composite = has_alpha_composite_support()
-
             if 'transparency' in img.info:
                 # non-paletted PNGs can have a fixed transparency value
                 # convert to RGBA to have full alpha
@@ -97,7 +101,7 @@ class LayerMerger(LayerMerger):
                 if opacity is not None and opacity < 1.0:
                     # fade-out img to add opacity value
                     img = img.convert("RGBA")
-                    alpha = img.split()[3]
+                    alpha = alpha_channel(img)
                     alpha = ImageChops.multiply(
                         alpha,
                         ImageChops.constant(alpha, int(255 * opacity))
@@ -107,7 +111,7 @@ class LayerMerger(LayerMerger):
                     # assume paletted images have transparency
                     if img.mode == 'P':
                         img = img.convert('RGBA')
-                    result = Image.alpha_composite(result, img)
+                    result = alpha_composite(result, img)
                 else:
                     result.paste(img, (0, 0))
             else:
@@ -132,6 +136,33 @@ class LayerMerger(LayerMerger):
 
         return ImageSource(result, size=size, image_opts=image_opts, cacheable=cacheable)
 
+def _is_unmodified_layer(layer_img, layer_coverage, image_opts, size):
+    """
+    Check if `layer_img` can be returned as the result of a merge
+    with this single layer.
+    """
+    layer_opts = layer_img.image_opts
+    # layer is opaque, no need to make transparent or add bgcolor
+    return bool(((layer_opts and not layer_opts.transparent) or image_opts.transparent)
+        and (not size or size == layer_img.size)
+        and (not layer_coverage or not layer_coverage.clip))
+
+def _is_opaque_layer(layer_img, layer_coverage, size):
+    """
+    Check if `layer_img` fully covers all layers below.
+    """
+    layer_opts = layer_img.image_opts
+    # transparent=None (default) does not mean that the image is opaque
+    if not (layer_opts and layer_opts.transparent is False
+        and (layer_opts.opacity is None or layer_opts.opacity >= 1.0)
+        and (not size or size == layer_img.size)
+        and (not layer_coverage or not layer_coverage.clip)):
+        return False
+    # the image itself can still have an alpha channel or transparency,
+    # the layer is merged anyway, so decoding it here costs nothing extra
+    img = layer_img.as_image()
+    return img.mode in ('RGB', 'L') and 'transparency' not in img.info
+
 
 band_ops = namedtuple("band_ops", ["dst_band", "src_img", "src_band", "factor"])
 
@@ -242,6 +273,15 @@ def merge_images(layers, image_opts, size=None, bbox=None, bbox_srs=None, merger
     :rtype: `ImageSource`
     """
     if merger is None:
+        if len(layers) == 1:
+            layer = layers[0]
+            if isinstance(layer, tuple):
+                layer_img, layer_coverage = layer
+            else:
+                layer_img, layer_coverage = layer, None
+            if (layer_img is not None
+                and _is_unmodified_layer(layer_img, layer_coverage, image_opts, size)):
+                return layer_img
         merger = LayerMerger()
 
     # BandMerger does not have coverage support, passing only images
@@ -286,7 +326,7 @@ def concat_legends(legends, format='png', size=None, bgcolor='#ffffff', transpar
             legend_height += tmp_img.size[1] #images shall not overlap themselfs
 
         size = [legend_width, legend_height]
-    bgcolor = ImageColor.getrgb(bgcolor)
+    bgcolor = parse_bgcolor(bgcolor)
 
     if transparent:
         img = Image.new('RGBA', size, bgcolor+(0,))
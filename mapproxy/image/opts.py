@@ -16,6 +16,7 @@
 
 import copy
 from mapproxy.compat import string_type
+from mapproxy.util.py import lru_cache
 
 class ImageOptions(object):
     def __init__(self, mode=None, transparent=None, opacity=None, resampling=None,
@@ -95,12 +96,21 @@ class ImageFormat(str):
     def __ne__(self, other):
         return not (self == other)
 
+@lru_cache(maxsize=64)
+def parse_bgcolor(color):
+    """
+    Return the RGB(A) tuple of a color string (e.g. '#ff0000').
+    Results are cached as the same few colors are parsed for each request.
+    """
+    from mapproxy.compat.image import ImageColor
+    return ImageColor.getrgb(color)
+
 def create_image(size, image_opts=None):
     """
     Create a new image that is compatible with the given `image_opts`.
     Takes into account mode, transparent, bgcolor.
     """
-    from mapproxy.compat.image import Image, ImageColor
+    from mapproxy.compat.image import Image
 
     if image_opts is None:
         mode = 'RGB'
@@ -116,7 +126,7 @@ def create_image(size, image_opts=None):
         bgcolor = image_opts.bgcolor or (255, 255, 255)
 
         if isinstance(bgcolor, string_type):
-            bgcolor = ImageColor.getrgb(bgcolor)
+            bgcolor = parse_bgcolor(bgcolor)
 
         if image_opts.transparent and len(bgcolor) == 3:
             bgcolor = bgcolor + (0, )
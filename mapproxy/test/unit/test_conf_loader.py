@@ -934,6 +934,37 @@ class TestImageOptions(object):
 
         conf.globals.image_options.image_opts({}, 'image/jpeg')
 
+        conf_dict['globals']['image']['formats']['image/jpeg']['encoding_options'] = {
+            'quantizer': 'libimagequant'
+        }
+        conf = ProxyConfiguration(conf_dict)
+
+        image_opts = conf.globals.image_options.image_opts({}, 'image/jpeg')
+        assert image_opts.encoding_options['quantizer'] == 'libimagequant'
+
+    def test_encoding_options_libimagequant_unsupported(self, caplog, monkeypatch):
+        monkeypatch.setattr('mapproxy.compat.image.has_libimagequant_support',
+            lambda: False)
+        conf_dict = {
+            'globals': {
+                'image': {
+                    'formats': {
+                        'image/png': {
+                            'encoding_options': {
+                                'quantizer': 'libimagequant',
+                            }
+                        }
+                    },
+                }
+            },
+        }
+        conf = ProxyConfiguration(conf_dict)
+
+        image_opts = conf.globals.image_options.image_opts({}, 'image/png')
+        assert image_opts.encoding_options['quantizer'] == 'libimagequant'
+        assert any('not compiled with libimagequant support' in msg
+            for _, _, msg in caplog.record_tuples)
+
 class TestCoverageValidation(object):
     def test_union(self):
         conf = {
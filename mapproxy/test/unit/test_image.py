@@ -21,7 +21,7 @@ from io import BytesIO
 
 import pytest
 
-from mapproxy.compat.image import Image, ImageDraw, PIL_VERSION
+from mapproxy.compat.image import Image, ImageDraw, PIL_VERSION, LIBIMAGEQUANT
 from mapproxy.image import (
     BlankImageSource,
     GeoReference,
@@ -72,6 +72,11 @@ class TestImageSource(object):
         assert is_png(ir.as_buffer())
         assert ir.as_image().size == (100, 100)
 
+    def test_from_missing_filename(self):
+        ir = ImageSource("/does/not/exist.png", PNG_FORMAT)
+        with pytest.raises(IOError):
+            ir.as_buffer()
+
     def test_from_file(self):
         with open(self.tmp_filename, "rb") as tmp_file:
             ir = ImageSource(tmp_file, "png")
@@ -98,6 +103,13 @@ class TestImageSource(object):
         assert ir.as_image().size == (100, 100)
         assert ir.as_buffer().read() == data
 
+        ir = ImageSource(FileLikeDummy(), "png")
+        assert isinstance(ir.as_buffer(), ReadBufWrapper)
+        assert ir.as_image().size == (100, 100)
+        buf = ir.as_buffer(seekable=True)
+        assert isinstance(buf, BytesIO)
+        assert buf.read() == data
+
     def test_output_formats(self):
         img = Image.new("RGB", (100, 100))
         for format in ["png", "gif", "tiff", "jpeg", "GeoTIFF", "bmp"]:
@@ -112,6 +124,65 @@ class TestImageSource(object):
         assert is_tiff(ir.as_buffer(TIFF_FORMAT))
         assert is_tiff(ir.as_buffer())
 
+    def test_converted_output_keeps_buffers(self):
+        with open(self.tmp_filename, "rb") as f:
+            png_buf = BytesIO(f.read())
+        ir = ImageSource(png_buf, (100, 100), PNG_FORMAT)
+        jpeg_buf = ir.as_buffer(JPEG_FORMAT)
+        jpeg_data = jpeg_buf.getvalue()
+        # previous buffers are returned without encoding
+        buf = ir.as_buffer(PNG_FORMAT)
+        assert buf.getvalue() == png_buf.getvalue()
+        assert ir.as_buffer(JPEG_FORMAT).getvalue() == jpeg_data
+
+    def test_converted_output_new_buffer_on_reuse(self):
+        with open(self.tmp_filename, "rb") as f:
+            png_buf = BytesIO(f.read())
+        ir = ImageSource(png_buf, (100, 100), PNG_FORMAT)
+        ir.as_buffer(JPEG_FORMAT)
+        first_buf = ir.as_buffer(PNG_FORMAT)
+        ir.as_buffer(JPEG_FORMAT)
+        first_buf.read(4)
+        buf = ir.as_buffer(PNG_FORMAT)
+        assert buf is not first_buf
+        assert is_png(buf)
+        # read position of the previous caller is not reset
+        assert first_buf.tell() == 4
+
+    def test_converted_output_reencodes_other_options(self):
+        with open(self.tmp_filename, "rb") as f:
+            png_buf = BytesIO(f.read())
+        ir = ImageSource(png_buf, (100, 100), PNG_FORMAT)
+        assert is_jpeg(ir.as_buffer(JPEG_FORMAT))
+        buf = ir.as_buffer(ImageOptions(format="image/png; mode=8bit", colors=256))
+        assert buf is not png_buf
+        assert Image.open(buf).mode == "P"
+
+    def test_converted_output_reencodes_other_jpeg_quality(self):
+        with open(self.tmp_filename, "rb") as f:
+            png_buf = BytesIO(f.read())
+        ir = ImageSource(png_buf, (100, 100), PNG_FORMAT)
+        low_buf = ir.as_buffer(
+            ImageOptions(format="image/jpeg", encoding_options={"jpeg_quality": 10})
+        )
+        assert is_png(ir.as_buffer(PNG_FORMAT))
+        high_buf = ir.as_buffer(
+            ImageOptions(format="image/jpeg", encoding_options={"jpeg_quality": 95})
+        )
+        assert is_jpeg(high_buf)
+        assert high_buf is not low_buf
+
+    def test_png_variants_not_converted(self):
+        with open(self.tmp_filename, "rb") as f:
+            png_buf = BytesIO(f.read())
+        ir = ImageSource(png_buf, (100, 100), PNG_FORMAT)
+        assert ir.as_buffer(ImageOptions(format="image/png8")) is png_buf
+
+        # quantize if the number of colors differs
+        buf = ir.as_buffer(ImageOptions(format="image/png8", colors=16))
+        assert buf is not png_buf
+        assert Image.open(buf).mode == "P"
+
     @pytest.mark.skipif(PIL_VERSION < '6.1.0', reason="Pillow 6.1.0 required GeoTIFF")
     def test_tiff_compression(self):
         def encoded_size(encoding_options):
@@ -228,6 +299,32 @@ class TestSubImageSource(object):
         assert img.getcolors() == [(100 * 100, (255, 255, 255, 0))]
 
 
+class TestBlankImageSource(object):
+
+    def test_cached_buffer(self):
+        opts = ImageOptions(format="image/png", bgcolor=(200, 100, 0))
+        data = BlankImageSource((20, 20), opts).as_buffer().read()
+        img = Image.open(BytesIO(data))
+        assert img.getcolors() == [(20 * 20, (200, 100, 0))]
+
+        blank = BlankImageSource((20, 20), opts)
+        assert blank.as_buffer().read() == data
+        # image is not created again
+        assert blank._img is None
+
+    def test_different_options(self):
+        opts = ImageOptions(format="image/png", bgcolor=(200, 100, 0))
+        data = BlankImageSource((20, 20), opts).as_buffer().read()
+
+        opts = ImageOptions(format="image/png", bgcolor=(200, 100, 1))
+        assert BlankImageSource((20, 20), opts).as_buffer().read() != data
+        opts = ImageOptions(format="image/png", bgcolor=(200, 100, 0), transparent=True)
+        assert BlankImageSource((20, 20), opts).as_buffer().read() != data
+        opts = ImageOptions(format="image/png", bgcolor=(200, 100, 0))
+        assert BlankImageSource((20, 21), opts).as_buffer().read() != data
+        assert is_jpeg(BlankImageSource((20, 20), opts).as_buffer(format="image/jpeg"))
+
+
 class ROnly(object):
 
     def __init__(self):
@@ -468,6 +565,89 @@ class TestLayerMerge(object):
         img = result.as_image()
         assert img.getpixel((0, 0)) == (0, 255, 255)
 
+    def test_single_layer(self):
+        img1 = ImageSource(
+            Image.new("RGB", (10, 10), (0, 255, 255)),
+            image_opts=ImageOptions(transparent=False),
+        )
+        assert merge_images([img1], ImageOptions(transparent=False)) is img1
+        assert merge_images([(img1, None)], ImageOptions(transparent=False)) is img1
+
+        # resize and transparent layers need a merge
+        result = merge_images([img1], ImageOptions(transparent=False), size=(20, 20))
+        assert result is not img1
+        assert result.size == (20, 20)
+        img2 = ImageSource(Image.new("RGBA", (10, 10), (0, 255, 255, 100)))
+        result = merge_images([img2], ImageOptions(transparent=False))
+        assert result is not img2
+        assert result.as_image().mode == "RGB"
+
+    def test_skip_layers_below_opaque(self):
+        # bottom layer would fail on load if it is not skipped
+        img1 = ImageSource(
+            "/does/not/exist.png", size=(10, 10), image_opts=ImageOptions(transparent=False)
+        )
+        img2 = ImageSource(
+            Image.new("RGB", (10, 10), (0, 255, 255)),
+            image_opts=ImageOptions(transparent=False),
+        )
+
+        result = merge_images([img1, img2], ImageOptions(transparent=False))
+        assert result is img2
+
+        img3 = ImageSource(Image.new("RGBA", (10, 10), (255, 0, 0, 0)))
+        result = merge_images([img1, img2, img3], ImageOptions(transparent=False))
+        img = result.as_image()
+        assert img.getpixel((0, 0)) == (0, 255, 255)
+
+    def test_no_skip_below_rgba(self):
+        img1 = ImageSource(Image.new("RGB", (10, 10), (255, 0, 0)))
+        raw = Image.new("RGBA", (10, 10), (0, 0, 255, 255))
+        raw.putpixel((0, 0), (0, 0, 255, 0))
+        # transparent=None is the default for most sources
+        for image_opts in (ImageOptions(format="image/png"), ImageOptions(transparent=False)):
+            img2 = ImageSource(raw, image_opts=image_opts)
+            result = merge_images([img1, img2], ImageOptions(transparent=False))
+            img = result.as_image()
+            assert img.mode == "RGB"
+            assert img.getpixel((0, 0)) == (255, 0, 0)
+            assert img.getpixel((1, 1)) == (0, 0, 255)
+
+    def test_no_skip_below_transparency_info(self):
+        img1 = ImageSource(Image.new("RGB", (10, 10), (255, 0, 0)))
+        raw = Image.new("RGB", (10, 10), (0, 255, 255))
+        raw.info = {"transparency": (0, 255, 255)}
+        img2 = ImageSource(raw, image_opts=ImageOptions(transparent=False))
+
+        result = merge_images([img1, img2], ImageOptions(transparent=False))
+        img = result.as_image()
+        assert img.getpixel((0, 0)) == (255, 0, 0)
+
+    def test_skip_layers_mixed_sizes(self):
+        img1 = ImageSource(Image.new("RGB", (20, 20), (255, 0, 255)))
+        img2 = ImageSource(
+            Image.new("RGB", (10, 10), (0, 255, 255)),
+            image_opts=ImageOptions(transparent=False),
+        )
+
+        # size of the first image is used
+        result = merge_images([img1, img2], ImageOptions(transparent=False))
+        img = result.as_image()
+        assert img.size == (20, 20)
+        assert img.getpixel((0, 0)) == (0, 255, 255)
+        assert img.getpixel((19, 19)) == (255, 0, 255)
+
+    def test_no_skip_below_opacity(self):
+        img1 = ImageSource(Image.new("RGB", (10, 10), (255, 0, 255)))
+        img2 = ImageSource(
+            Image.new("RGB", (10, 10), (0, 255, 255)),
+            image_opts=ImageOptions(transparent=False, opacity=0.5),
+        )
+
+        result = merge_images([img1, img2], ImageOptions(transparent=False))
+        img = result.as_image()
+        assert img.getpixel((0, 0)) == (127, 127, 255)
+
     def test_merge_rgb_with_transp(self):
         img1 = ImageSource(Image.new("RGB", (10, 10), (255, 0, 255)))
         raw = Image.new("RGB", (10, 10), (0, 255, 255))
@@ -680,6 +860,51 @@ class TestMesh(object):
             assert e == pytest.approx(a, abs=1e-9)
 
 
+class TestQuantize(object):
+
+    def test_mediancut_alpha(self):
+        img = Image.new("RGBA", (50, 50), (0, 255, 0, 255))
+        draw = ImageDraw.Draw(img)
+        draw.rectangle((25, 25, 49, 49), fill=(0, 0, 0, 100))
+        defaults = {}
+        img = quantize(img, alpha=True, defaults=defaults, quantizer="mediancut")
+        assert img.mode == "P"
+        assert defaults["transparency"] == 255
+        assert img.getpixel((49, 49)) == 255
+        assert img.getpixel((0, 0)) != 255
+
+    @pytest.mark.parametrize("mode", ["RGB", "RGBA", "L", "P"])
+    def test_mediancut(self, mode):
+        img = create_debug_img((50, 50), transparent=False).convert(mode)
+        result = quantize(img, colors=16, quantizer="mediancut")
+        assert result.mode == "P"
+        assert 1 < len(result.getcolors()) <= 16
+
+    def test_libimagequant_alpha(self):
+        img = Image.new("RGBA", (50, 50), (0, 255, 0, 255))
+        draw = ImageDraw.Draw(img)
+        draw.rectangle((25, 25, 49, 49), fill=(0, 0, 0, 0))
+        # falls back to fastoctree without libimagequant support
+        img = quantize(img, alpha=True, quantizer="libimagequant")
+        assert img.mode == "P"
+        assert img_has_transparency(img)
+
+    def test_libimagequant_method(self, monkeypatch):
+        monkeypatch.setattr("mapproxy.image.has_libimagequant_support", lambda: True)
+        methods = []
+        orig_quantize = Image.Image.quantize
+        def quantize_method(img, colors=256, method=None, *args, **kw):
+            methods.append(method)
+            # Pillow here might not be compiled with libimagequant
+            return orig_quantize(img, colors, Image.FASTOCTREE)
+        monkeypatch.setattr(Image.Image, "quantize", quantize_method)
+
+        img = create_debug_img((50, 50), transparent=False)
+        img = quantize(img, colors=16, quantizer="libimagequant")
+        assert img.mode == "P"
+        assert methods == [LIBIMAGEQUANT]
+
+
 class TestSingleColorImage(object):
 
     def test_one_point(self):
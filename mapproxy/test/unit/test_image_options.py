@@ -49,6 +49,17 @@ class TestCreateImage(object):
         assert img.mode == "RGB"
         assert img.getcolors() == [(100 * 100, (200, 100, 0))]
 
+    def test_bgcolor_string(self):
+        img = create_image((100, 100), ImageOptions(bgcolor="#c86400"))
+        assert img.mode == "RGB"
+        assert img.getcolors() == [(100 * 100, (200, 100, 0))]
+
+        img = create_image(
+            (100, 100), ImageOptions(bgcolor="#c86400", transparent=True)
+        )
+        assert img.mode == "RGBA"
+        assert img.getcolors() == [(100 * 100, (200, 100, 0, 0))]
+
     def test_rgba_bgcolor(self):
         img = create_image((100, 100), ImageOptions(bgcolor=(200, 100, 0, 30)))
         assert img.size == (100, 100)
@@ -79,3 +79,27 @@ def memoize(func):
         return cache[key]
     return wrapper
 
+try:
+    from functools import lru_cache
+except ImportError:
+    # Python 2
+    def lru_cache(maxsize=128):
+        """
+        Minimal replacement for `functools.lru_cache`. Only positional
+        arguments are supported and the whole cache is cleared when
+        `maxsize` is reached.
+        """
+        def decorator(func):
+            cache = {}
+            @wraps(func)
+            def wrapper(*args):
+                try:
+                    return cache[args]
+                except KeyError:
+                    pass
+                if len(cache) >= maxsize:
+                    cache.clear()
+                result = cache[args] = func(*args)
+                return result
+            return wrapper
+        return decorator